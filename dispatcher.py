@@ -4,7 +4,9 @@
 """
 Dispatcher 负责：
 1) 维护 Runner 列表与状态（是否 busy、最后心跳时间 last_seen)
-2) 用 Round-Robin(轮询)在空闲 Runner 之间做负载均衡派发
+2) 每个 Runner 一个本地队列 + 独立派发协程（共用一个 asyncio 事件循环线程，非阻塞 connect）；
+   新任务优先交给空闲 Runner(Round-Robin)，否则按 Round-Robin 放入某个 Runner 的本地队列；
+   本地队列空时向邻居“偷”任务(work-stealing)
 3) 接收 Runner 的心跳(HEARTBEAT)，若超时则判定掉线并回收任务
 4) 支持任务自动重试（最多 RETRY_MAX 次）
 5) 记录每个 commit 的时间线:queued_at / assigned_at / completed_at 及分配到的 runner
@@ -17,32 +19,125 @@ import queue
 import time
 import os
 import argparse
-from datetime import datetime
-from collections import deque          # ✅ 轮询队列需要 deque
+import asyncio
+import atexit
+from array import array
+from collections import deque, namedtuple   # ✅ 轮询队列需要 deque
 from utils import log
 
 # ===== 调度/容错相关参数（可按需微调） =====
+# 注：所有间隔/超时判断都基于 time.monotonic()，不受 NTP 校时、夏令时等墙上时钟跳变影响；
+#     time.time() 只用于写进结果文件、给人看的时间戳
 HEARTBEAT_SECS   = 5.0    # Runner 建议每 5s 上报一次心跳
 RUNNER_DEAD_SECS = 15.0   # 超过该时长未见心跳 => 判定 Runner 掉线
 RETRY_MAX        = 3      # 单个 commit 最大自动重试次数
-ASSIGN_TICK      = 0.2    # 派发线程空转时的睡眠间隔
+ASSIGN_TICK      = 0.2    # 派发协程等待本地队列/空转时的间隔
+DISPATCH_TIMEOUT = 5.0    # 下发 RUN 时 connect / 等待回复的超时
 CLEANUP_TICK     = 1.0    # 清道夫线程巡检间隔
+ACTOR_CALL_TIMEOUT = 2.0  # 同步等待 state actor 回复的上限（须小于对端的 CONNECT_TIMEOUT，超时回 ERR）
+HANDLER_TIMEOUT  = HEARTBEAT_SECS * 2  # 指令连接的读写超时：必须大于心跳间隔，否则健康的长连接会被误断
+# 不变式（runner.py / repo_observer.py 的 CONNECT_TIMEOUT = HEARTBEAT_SECS + 2）：
+#   CONNECT_TIMEOUT < RUNNER_DEAD_SECS < HEARTBEAT_SECS * (RETRY_MAX + 1)
+# 单个包延迟只会让一次收发超时，不会直接导致 runner 被判定掉线、任务被批量回收
 RESULTS_DIR      = "test_results"  # 测试结果输出目录
+MAX_LINE_BYTES   = 4096   # 单条指令（含换行）的最大长度，超过即视为协议错误
+
+# ===== 预编码的固定协议回复（省掉每次请求的 str -> bytes 编码） =====
+_REGISTERED = b"REGISTERED\n"
+_ALIVE      = b"ALIVE\n"
+_QUEUED     = b"QUEUED\n"
+_ACK        = b"ACK\n"
+_ERR        = b"ERR\n"
+_DUP        = b"ALREADY-QUEUED\n"
+
+# ====== Runner 热字段表：按列存储（SoA） ======
+class RunnerTable:
+    """
+    所有 runner 的 last_seen / busy 分别存成一段连续内存（array('d') / bytearray），按槽位下标访问：
+    清道夫扫描心跳只需遍历一个 array，挑选空闲 runner 只读一个字节。
+    - ids：槽位 -> rid，空闲槽位为 None
+    - last_seen：最近一次心跳的 time.monotonic()；心跳热路径直接按下标赋值，无需加锁
+    - busy：只在持有该 runner 的 RunnerMeta.lock 时翻转
+    槽位在 runner 生命周期内固定：驱逐时只标记为空闲并放入 free，下次注册复用，
+    不做 swap-with-last 压缩，这样无锁的心跳写入不会因为下标搬家而写到别的 runner 上。
+    add/remove 需在持有 runners_lock 时调用。
+    """
+    def __init__(self):
+        self.ids = []
+        self.last_seen = array("d")
+        self.busy = bytearray()
+        self.free = []
+
+    def add(self, rid) -> int:
+        now = time.monotonic()
+        if self.free:
+            i = self.free.pop()
+            self.ids[i] = rid
+            self.last_seen[i] = now
+            self.busy[i] = 0
+        else:
+            i = len(self.ids)
+            self.ids.append(rid)
+            self.last_seen.append(now)
+            self.busy.append(0)
+        return i
+
+    def remove(self, i):
+        self.ids[i] = None
+        self.busy[i] = 0
+        self.free.append(i)
+
+    def expired(self, now, max_age):
+        """返回心跳超时的 (rid, last_seen) 列表（无锁扫描，允许读到稍旧的数据）。"""
+        ids = self.ids
+        return [(ids[i], t) for i, t in enumerate(self.last_seen)
+                if now - t > max_age and ids[i] is not None]
+
+# ====== 单个 Runner 的运行时信息 ======
+class RunnerMeta:
+    """
+    runners 字典中的 value。使用 __slots__ 避免每个 runner 一个 dict。
+    - idx：该 runner 在 RunnerTable 中的槽位（busy/last_seen 存在表里）；被驱逐后置为 None
+    - lock：保护本 runner 的 busy 翻转与 idx 失效
+    - local_q：该 runner 的本地待派发队列，由它自己的派发协程消费，空闲的邻居也可以来偷
+    - wakeup：派发协程空等时挂在上面的 asyncio.Event（由协程自己创建），有新任务入队时唤醒
+    """
+    __slots__ = ("idx", "lock", "local_q", "wakeup")
+
+    def __init__(self, idx):
+        self.idx = idx
+        self.lock = threading.Lock()
+        self.local_q = queue.SimpleQueue()
+        self.wakeup = None
 
 # ====== 全局状态对象 ======
 class DispatcherState:
     """
-    统一保存 Dispatcher 的全部共享状态。所有读写需要通过 self.lock 保证线程安全。
+    统一保存 Dispatcher 的全部共享状态，避免所有操作串行在一把大锁上：
+    - runners_lock：保护 runners 字典与 RunnerTable 槽位的增删、runner_ring 与 idle_ring 的出队
+    - RunnerMeta.lock：保护单个 runner 的 busy，以及它在 idle_ring 中的登记
+    - assigned / tasks / in_flight / commits：不加锁，只由 state actor 线程读写（见 state_actor_loop）；
+      其它线程通过 post()/call() 投递消息，由 actor 顺序执行对应的 _op_* 方法
     """
     def __init__(self):
-        # runners 映射：key = (host, port)，value = {"busy": bool, "last_seen": float}
+        # runners 映射：key = (host, port)，value = RunnerMeta
         self.runners = {}
 
+        # 所有 runner 的 busy / last_seen（按列存储，见 RunnerTable）
+        self.table = RunnerTable()
+
         # 轮询队列：按注册顺序保存所有 runner_id（(host,port) 元组），用于 Round-Robin
         self.runner_ring = deque()
 
-        # 待分配的 commit 队列（先进先出）
-        self.pending = queue.Queue()
+        # 空闲轮询队列：只放“可能空闲”的 runner，挑选空闲 runner 时 O(1) 出队
+        # 惰性删除：runner 变忙/被驱逐时不从这里删，出队时发现不再空闲才丢弃
+        # rid_in_idle 记录当前已在 idle_ring 中的 runner，避免重复入队
+        self.idle_ring = deque()
+        self.rid_in_idle = set()
+
+        # 全局溢出队列：没有任何 runner 时暂存 commit，各派发协程空闲时也会从这里取
+        # 用 SimpleQueue（C 实现、无 task_done/join 记账），入队/出队开销更低
+        self.pending = queue.SimpleQueue()
 
         # 已分配但未完成：commit -> runner_id((host,port))
         self.assigned = {}
@@ -50,96 +145,347 @@ class DispatcherState:
         # 任务重试与时间线：commit -> {"retry": int, "queued_at": ts, ...}
         self.tasks = {}
 
+        # 活跃 commit：已入队或已分配、尚未出结果（也未被丢弃）的 commit，用于 DISPATCH 去重
+        self.in_flight = set()
+
         # 记录每个 commit 的时间线与分配信息（用于结果落盘）
         # self.commits[commit] = {
-        #   "queued_at": ts, "assigned_at": ts, "completed_at": ts, "runner": (host,port)
+        #   "queued_at": ts, "assigned_at": ts, "completed_at": ts, "runner": (host,port),
+        #   "queued_mono": mt, "assigned_mono": mt, "completed_mono": mt
         # }
+        # *_at 为墙上时间（写进结果文件），*_mono 为单调时钟（只用来算各阶段耗时）
         self.commits = {}
 
-        # 互斥锁，保障多线程访问一致性
-        self.lock = threading.Lock()
+        # runners_lock 可重入，便于在已持锁的方法里再次进入
+        self.runners_lock = threading.RLock()
+
+        # state actor 的消息队列：元素为 (op, args, reply)，reply 为 None 表示不需要返回值
+        self.state_actor_q = queue.SimpleQueue()
 
     # --- 工具方法：确保结果目录存在 ---
     def _ensure_results_dir(self):
         os.makedirs(RESULTS_DIR, exist_ok=True)
 
-    # --- 注册 Runner：加入 runners 字典与轮询队列 ---
+    # --- 注册 Runner：加入 runners 字典与轮询队列，并启动它专属的派发协程 ---
     def register_runner(self, host, port):
         rid = (host, port)
-        with self.lock:
-            if rid not in self.runners:
-                self.runners[rid] = {"busy": False, "last_seen": time.time()}
+        with self.runners_lock:
+            is_new = rid not in self.runners
+            if is_new:
+                self.runners[rid] = RunnerMeta(self.table.add(rid))
                 self.runner_ring.append(rid)  # 放入轮询队列
+                if rid not in self.rid_in_idle:
+                    self.rid_in_idle.add(rid)
+                    self.idle_ring.append(rid)  # 新 runner 一定是空闲的
+        if is_new:
+            _start_runner_dispatch(rid)
         log(f"runner registered: {host}:{port}")
 
-    # --- 记录心跳：仅更新 last_seen ---
+    # --- 记录心跳：仅更新 last_seen（无锁，按下标写 array 在 GIL 下是原子的） ---
     def heartbeat(self, host, port):
-        rid = (host, port)
-        with self.lock:
-            r = self.runners.get(rid)
-            if r is not None:
-                r["last_seen"] = time.time()
-
-    # --- 从系统中移除 Runner，并回收它正在处理的任务 ---
-    def evict_runner(self, rid):
-        with self.lock:
-            # 回收该 runner 正在处理的所有 commit（自动重试）
-            for commit, assigned_rid in list(self.assigned.items()):
-                if assigned_rid == rid:
-                    self._requeue_commit_locked(commit, reason="runner_evicted")
-
-            # 真正移除 runner
-            if rid in self.runners:
+        r = self.runners.get((host, port))
+        if r is not None:
+            i = r.idx
+            if i is not None:
+                self.table.last_seen[i] = time.monotonic()
+
+    # --- runner 是否正忙；已被驱逐的 runner 视为忙（不再给它派活） ---
+    def is_busy(self, meta):
+        i = meta.idx
+        return i is None or bool(self.table.busy[i])
+
+    # --- 从系统中移除 Runner，并回收它正在处理/排队中的任务 ---
+    # last_seen：调用方（清道夫）判定超时时看到的心跳时间；若持锁复核时发现心跳已更新，
+    #            说明期间又收到了 HEARTBEAT，放弃驱逐并返回 False
+    def evict_runner(self, rid, last_seen=None):
+        # 先真正移除 runner，避免回收的任务又被派回给它
+        with self.runners_lock:
+            meta = self.runners.get(rid)
+            if meta is not None:
+                with meta.lock:
+                    if last_seen is not None and self.table.last_seen[meta.idx] != last_seen:
+                        log(f"runner evict aborted (heartbeat arrived): {rid[0]}:{rid[1]}")
+                        return False
+                    # 归还槽位；之后对该 meta 的 busy 写入一律忽略
+                    self.table.remove(meta.idx)
+                    meta.idx = None
                 del self.runners[rid]
             # 同步从轮询队列删除
             try:
                 self.runner_ring.remove(rid)
             except ValueError:
                 pass  # 不在 ring 里就忽略
+
+        # 回收该 runner 正在处理的所有 commit（自动重试），交给 state actor 处理
+        self.post("evict", rid)
+
+        # 本地队列里还没派出去的 commit 原样转交给其它 runner（不计重试）
+        if meta is not None:
+            while True:
+                try:
+                    commit = meta.local_q.get_nowait()
+                except queue.Empty:
+                    break
+                self.submit(commit)
         log(f"runner evicted: {rid[0]}:{rid[1]}")
+        return True
+
+    # --- 提交一个 commit：优先交给空闲 runner，否则按 RR 放入某个 runner 的本地队列 ---
+    def submit(self, commit):
+        with self.runners_lock:
+            rid = self.pick_idle_runner_rr()
+            if rid is None and self.runner_ring:
+                rid = self.runner_ring[0]
+                self.runner_ring.rotate(-1)
+            meta = self.runners[rid] if rid is not None else None
+            if meta is None:
+                self.pending.put(commit)
+                return
+            # 必须在锁内入队：否则 evict_runner 可能在选中之后、入队之前驱逐该 runner 并排空它的本地队列，
+            # commit 会落进一个再也没人读的队列（SimpleQueue.put 不会阻塞，持锁入队没有代价）
+            meta.local_q.put(commit)
+        # 唤醒该 runner 正在空等的派发协程（Event 不是线程安全的，交给事件循环去 set）
+        if meta.wakeup is not None:
+            _dispatch_loop.call_soon_threadsafe(meta.wakeup.set)
+
+    # --- 本地队列为空时：先取全局溢出队列，再按 RR 顺序从邻居本地队列偷一个 ---
+    def steal(self, rid):
+        try:
+            return self.pending.get_nowait()
+        except queue.Empty:
+            pass
+        with self.runners_lock:
+            ring = list(self.runner_ring)
+            peers = [self.runners[r] for r in ring if r != rid]
+        # 从自己的下一个邻居开始，保证偷取压力均匀分布
+        if rid in ring:
+            i = ring.index(rid)
+            peers = peers[i:] + peers[:i]
+        for peer in peers:
+            try:
+                return peer.local_q.get_nowait()
+            except queue.Empty:
+                continue
+        return None
+
+    # --- 当前排队（尚未派出）的 commit 数：全局溢出队列 + 各 runner 本地队列（近似值） ---
+    def pending_count(self):
+        return self.pending.qsize() + sum(m.local_q.qsize() for m in list(self.runners.values()))
+
+    # --- 异步投递一条消息给 state actor（不等结果） ---
+    def post(self, op, *args):
+        self.state_actor_q.put((op, args, None))
+
+    # --- 同步调用 state actor：投递消息并等待返回值；超时（actor 未运行或已停止）返回 None ---
+    def call(self, op, *args):
+        reply = queue.SimpleQueue()
+        self.state_actor_q.put((op, args, reply))
+        try:
+            return reply.get(timeout=ACTOR_CALL_TIMEOUT)
+        except queue.Empty:
+            log(f"state actor did not answer {op} within {ACTOR_CALL_TIMEOUT}s")
+            return None
 
-    # --- 将 commit 放回 pending 队列并增加重试计数（需要在已持锁环境调用） ---
-    def _requeue_commit_locked(self, commit, reason=""):
+    # ===== 以下 _op_* 只能在 state actor 线程中调用 =====
+
+    # --- 登记并提交一个新 commit；同一个 commit 还在排队/执行中则返回 False ---
+    def _op_dispatch(self, commit, wall, mono):
+        if commit in self.in_flight:
+            return False
+        self.in_flight.add(commit)
+        # init 任务元数据
+        self.tasks.setdefault(commit, {"retry": 0})
+        meta = self.commits.setdefault(commit, {})
+        meta["queued_at"] = wall
+        meta["queued_mono"] = mono
+        self.submit(commit)
+        return True
+
+    # --- RUN 下发成功：记录时间线与映射 ---
+    def _op_assigned(self, commit, rid, wall, mono):
+        # RESULT 比本消息先到（测试极快时可能发生）：commit 已完成，直接释放 runner
+        if commit not in self.in_flight:
+            self.set_busy(rid, False)
+            return
+        # runner 在 RUN 下发后、本消息处理前已被驱逐：_op_evict 已经跑过，不会再回收这个 commit，
+        # 若照常记录会让它永远卡在 assigned / in_flight，只能在这里直接重新入队
+        if rid not in self.runners:
+            self._op_requeue(commit, reason="runner_evicted")
+            return
+        self.assigned[commit] = rid
+        info = self.commits.setdefault(commit, {})
+        info["assigned_at"] = wall
+        info["assigned_mono"] = mono
+        info["runner"] = rid
+
+    # --- 收到 RESULT：释放 runner、记录完成时间，并把时间线快照交给结果写线程 ---
+    def _op_result(self, commit, status, seconds, wall, mono):
+        rid = self.assigned.pop(commit, None)
+        self.in_flight.discard(commit)
+        if rid:
+            self.set_busy(rid, False)
+        meta = self.commits.setdefault(commit, {})
+        meta["completed_at"] = wall
+        meta["completed_mono"] = mono
+        _result_writer_q.put(ResultRecord(commit, status, seconds, wall, dict(meta)))
+
+    # --- runner 被驱逐：回收它正在处理的所有 commit（自动重试） ---
+    def _op_evict(self, rid):
+        for commit, assigned_rid in list(self.assigned.items()):
+            if assigned_rid == rid:
+                self._op_requeue(commit, reason="runner_evicted")
+
+    # --- 将 commit 重新提交并增加重试计数 ---
+    def _op_requeue(self, commit, reason=""):
         # 取出/新建任务记录
         task = self.tasks.setdefault(commit, {"retry": 0})
         # 该 commit 不再处于“已分配”状态
         self.assigned.pop(commit, None)
 
+        # 已经出结果的 commit 不再重新入队（例如 RESULT 与驱逐并发）
+        if commit not in self.in_flight:
+            return
+
         # 达到最大重试次数 => 丢弃
         if task["retry"] >= RETRY_MAX:
+            self.in_flight.discard(commit)
             log(f"drop commit={commit} after {task['retry']} retries (reason={reason})")
             return
 
         # 增加重试计数并重新入队
         task["retry"] += 1
-        self.pending.put(commit)
+        self.submit(commit)
         log(f"requeue commit={commit} retry={task['retry']} (reason={reason})")
 
     # --- Round-Robin 选取一个“当前空闲”的 runner；若都忙则返回 None ---
     def pick_idle_runner_rr(self):
-        with self.lock:
-            if not self.runner_ring:
-                return None
-            n = len(self.runner_ring)
-            # 轮询 n 次，寻找第一个不 busy 的 runner
-            for _ in range(n):
-                rid = self.runner_ring[0]          # 查看队头
-                self.runner_ring.rotate(-1)        # 把队头移到队尾（实现公平轮询）
+        with self.runners_lock:
+            while self.idle_ring:
+                rid = self.idle_ring.popleft()     # 取队头
                 meta = self.runners.get(rid)
-                if meta and (not meta["busy"]):
-                    return rid
+                if meta is None:
+                    self.rid_in_idle.discard(rid)  # 已被驱逐：惰性删除
+                    continue
+                with meta.lock:
+                    if self.table.busy[meta.idx]:
+                        self.rid_in_idle.discard(rid)  # 已变忙：惰性删除，空闲后由 set_busy 重新入队
+                        continue
+                    self.idle_ring.append(rid)     # 仍空闲：放回队尾（实现公平轮询）
+                return rid
             return None
 
-    # --- 标记 runner 的 busy 状态 ---
+    # --- 标记 runner 的 busy 状态（只持有该 runner 自己的锁）；变为空闲时重新登记到 idle_ring ---
     def set_busy(self, rid, busy: bool):
-        with self.lock:
-            r = self.runners.get(rid)
-            if r is not None:
-                r["busy"] = busy
+        r = self.runners.get(rid)
+        if r is not None:
+            with r.lock:
+                if r.idx is None:
+                    return  # 已被驱逐
+                self.table.busy[r.idx] = busy
+                if not busy and rid not in self.rid_in_idle:
+                    self.rid_in_idle.add(rid)
+                    self.idle_ring.append(rid)
 
 # 全局唯一状态
 STATE = DispatcherState()
 
+# ====== 结果落盘：RESULT 只负责入队，由后台写线程批量写文件 ======
+ResultRecord = namedtuple("ResultRecord", "commit status seconds completed_at meta")
+RESULT_BATCH_MAX = 64     # 写线程单次最多合并的结果条数
+_result_writer_q = queue.SimpleQueue()
+_RESULT_STOP = object()   # 停止哨兵：写线程写完手头的批次后退出
+_result_writer = None     # 写线程引用，退出时 join 等它落盘
+_state_actor = None       # state actor 线程引用，退出时先等它处理完手头的消息
+_ACTOR_STOP = ("stop", (), None)  # state actor 停止消息：之前投递的消息都处理完后退出
+
+# 结果文件的固定部分；可选行（runner/各阶段耗时）在后面按需追加
+_RESULT_TMPL = (
+    "commit={}\n"
+    "status={}\n"
+    "duration_seconds_runner={}\n"   # Runner 回传的测试耗时
+    "queued_at_local={}\n"
+    "assigned_at_local={}\n"
+    "completed_at_local={}\n"
+)
+
+# --- 小函数：把时间戳格式化成人类可读（本地时间 ISO 格式，不构造 datetime 对象） ---
+def _fmt_ts(ts_float):
+    if ts_float is None:
+        return ""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(ts_float)) + f".{int(ts_float % 1 * 1e6):06d}"
+
+# --- 把一条结果写成 results/<commit>.txt（含时间线信息） ---
+def _write_result(rec):
+    queued_at    = rec.meta.get("queued_at")
+    assigned_at  = rec.meta.get("assigned_at")
+    runner_info  = rec.meta.get("runner")
+    completed_at = rec.completed_at
+
+    # 计算各阶段耗时（用单调时钟，避免墙上时钟跳变算出负数）
+    q_mono = rec.meta.get("queued_mono")
+    a_mono = rec.meta.get("assigned_mono")
+    c_mono = rec.meta.get("completed_mono")
+    q_to_a = (a_mono - q_mono) if (q_mono is not None and a_mono is not None) else None
+    a_to_c = (c_mono - a_mono) if (a_mono is not None and c_mono is not None) else None
+    total  = (c_mono - q_mono) if (q_mono is not None and c_mono is not None) else None
+
+    # 先拼出完整内容，再一次 write 落盘
+    body = [_RESULT_TMPL.format(rec.commit, rec.status, rec.seconds,
+                                _fmt_ts(queued_at), _fmt_ts(assigned_at), _fmt_ts(completed_at))]
+    if runner_info:
+        body.append(f"runner_host={runner_info[0]}\nrunner_port={runner_info[1]}\n")
+    if q_to_a is not None:
+        body.append(f"latency_queue_to_assign_sec={q_to_a:.3f}\n")
+    if a_to_c is not None:
+        body.append(f"latency_assign_to_finish_sec={a_to_c:.3f}\n")
+    if total is not None:
+        body.append(f"latency_total_sec={total:.3f}\n")
+
+    path = os.path.join(RESULTS_DIR, f"{rec.commit}.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(body))
+
+# --- 写线程：阻塞等第一条，再非阻塞地捎带后续若干条，一批写完 ---
+def _result_writer_loop():
+    STATE._ensure_results_dir()
+    while True:
+        batch = {}
+        stop = False
+        rec = _result_writer_q.get()
+        while rec is not _RESULT_STOP:
+            batch[rec.commit] = rec   # 同一 commit 在一批内只保留最新一条，只打开一次文件
+            if len(batch) >= RESULT_BATCH_MAX:
+                break
+            try:
+                rec = _result_writer_q.get(timeout=0.05)
+            except queue.Empty:
+                break
+        else:
+            stop = True
+        for rec in batch.values():
+            try:
+                _write_result(rec)
+            except OSError as e:
+                log(f"write result for {rec.commit} failed: {e}")
+                continue
+            log(f"result {rec.commit} -> {os.path.join(RESULTS_DIR, rec.commit + '.txt')}")
+        if stop:
+            return
+
+# --- 退出前把队列里剩余的结果写完（KeyboardInterrupt 与 atexit 都会调用，重复调用无副作用） ---
+def _shutdown_result_writer():
+    global _result_writer, _state_actor
+    # RESULT 先经过 state actor 才进入写队列：必须先排空 state_actor_q，再排空 _result_writer_q
+    actor, _state_actor = _state_actor, None
+    if actor is not None:
+        STATE.state_actor_q.put(_ACTOR_STOP)
+        actor.join(timeout=5.0)
+    writer, _result_writer = _result_writer, None
+    if writer is None:
+        return
+    _result_writer_q.put(_RESULT_STOP)
+    writer.join(timeout=5.0)
+
 # ====== TCPServer 基类：多线程处理连接 ======
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True         # handler 线程设为守护线程，随主进程退出
@@ -148,184 +494,238 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 # ====== 文本协议 Handler ======
 class Handler(socketserver.StreamRequestHandler):
     """
-    协议：一行一条指令（空格分隔），常见类型：
+    协议：一行一条指令（空格分隔），每条指令回复一行，常见类型：
     - STATUS
     - REGISTER <runner_host> <runner_port>
     - HEARTBEAT <runner_host> <runner_port>
     - DISPATCH <commit>
     - RESULT <commit> <status> <seconds>
+    同一连接上可以连续发送多条指令（Runner 用长连接复用 HEARTBEAT/RESULT），直到对端关闭。
+    连接空闲超过 HANDLER_TIMEOUT 即关闭，Runner 下次发送时会自动重连。
     """
+    timeout = HANDLER_TIMEOUT     # StreamRequestHandler.setup() 会据此对连接 settimeout
+
     def handle(self):
-        # 读取一行指令（阻塞直到读到换行或对端关闭）
-        line = self.rfile.readline().decode("utf-8").strip()
-        if not line:
+        # 直接用 rfile.readline()：实测比在 recv_into 缓冲区里按偏移原地切词更快，
+        # 逐字节扫描的 Python 循环比 C 实现的 readline + split 多出来的几次小分配更贵
+        while True:
+            try:
+                raw = self.rfile.readline(MAX_LINE_BYTES)
+            except socket.timeout:
+                return  # 空闲太久：关闭连接，释放 handler 线程
+            if not raw:
+                return  # 对端关闭连接（最后一条指令没有换行时 readline 也会照常返回它）
+            if len(raw) == MAX_LINE_BYTES and not raw.endswith(b"\n"):
+                self.wfile.write(_ERR)  # 单行超长：协议错误，断开连接
+                return
+            if not self._handle_line(raw):
+                return  # 参数格式错误：已回 ERR，断开连接
+
+    # --- 处理一行指令；返回 False 表示应断开连接 ---
+    def _handle_line(self, raw):
+        # 指令最多 4 段（RESULT <commit> <status> <seconds>），限定切分次数；
+        # 按任意空白切分，容忍连续空格 / 制表符 / 行尾 \r
+        parts = raw.split(None, 3)
+        if not parts:
+            return True  # 空行
+        # 直接用字节串查指令表；只有查不到时才退回大小写不敏感匹配
+        entry = self._COMMANDS.get(parts[0]) or self._COMMANDS.get(parts[0].upper())
+        if entry is None or len(parts) - 1 < entry[1]:
+            # 未知指令或参数不足
+            self.wfile.write(_ERR)
+            return True
+        try:
+            entry[0](self, [p.decode("utf-8") for p in parts[1:]])
+        except ValueError:
+            self.wfile.write(_ERR)  # 参数格式错误（如端口不是数字、非 UTF-8）：断开连接
+            return False
+        return True
+
+    def _do_status(self, args):
+        # 返回可观测的队列与 runner 数量，便于外部探测（无锁读取，近似值即可）
+        runners = len(STATE.runners)
+        pending = STATE.pending_count()
+        assigned = len(STATE.assigned)
+        self.wfile.write(f"OK RUNNERS {runners} PENDING {pending} ASSIGNED {assigned}\n".encode())
+
+    def _do_register(self, args):
+        # Runner 启动后主动注册：登记在册并进入轮询队列
+        host, port = args[0], int(args[1])
+        STATE.register_runner(host, port)
+        self.wfile.write(_REGISTERED)
+
+    def _do_heartbeat(self, args):
+        # Runner 定期上报心跳：仅更新 last_seen
+        host, port = args[0], int(args[1])
+        STATE.heartbeat(host, port)
+        self.wfile.write(_ALIVE)
+
+    def _do_dispatch(self, args):
+        # 外部（如 repo_observer）提交一个需要测试的 commit
+        commit = args[0]
+        if not commit:
+            self.wfile.write(_ERR)
+            return
+        # 登记与入队由 state actor 完成；同一个 commit 还在排队/执行中则拒绝，避免重复占用 runner
+        queued = STATE.call("dispatch", commit, time.time(), time.monotonic())
+        if queued is None:
+            self.wfile.write(_ERR)  # actor 执行出错或未及时回复（已记录日志）
+            return
+        if not queued:
+            self.wfile.write(_DUP)
+            log(f"duplicate commit {commit} ignored")
+            return
+        self.wfile.write(_QUEUED)
+        log(f"queued commit {commit}")
+
+    def _do_result(self, args):
+        # Runner 测试完成后回传结果：RESULT <commit> <status> <seconds>
+        # 切分次数有限，多余字段会留在最后一段里：只取其第一个词，与原先 split() 忽略多余字段一致
+        commit, status, seconds = args[0], args[1], args[2].split()[0]
+        if not commit:
+            self.wfile.write(_ERR)  # 空 commit 会写出 test_results/.txt
             return
 
-        parts = line.split()
-        cmd = parts[0].upper()
-
-        if cmd == "STATUS":
-            # 返回可观测的队列与 runner 数量，便于外部探测
-            with STATE.lock:
-                runners = len(STATE.runners)
-                pending = STATE.pending.qsize()
-                assigned = len(STATE.assigned)
-            self.wfile.write(f"OK RUNNERS {runners} PENDING {pending} ASSIGNED {assigned}\n".encode())
-
-        elif cmd == "REGISTER" and len(parts) >= 3:
-            # Runner 启动后主动注册：登记在册并进入轮询队列
-            host, port = parts[1], int(parts[2])
-            STATE.register_runner(host, port)
-            self.wfile.write(b"REGISTERED\n")
-
-        elif cmd == "HEARTBEAT" and len(parts) >= 3:
-            # Runner 定期上报心跳：仅更新 last_seen
-            host, port = parts[1], int(parts[2])
-            STATE.heartbeat(host, port)
-            self.wfile.write(b"ALIVE\n")
-
-        elif cmd == "DISPATCH" and len(parts) >= 2:
-            # 外部（如 repo_observer）提交一个需要测试的 commit
-            commit = parts[1]
-            # init 任务元数据与入队
-            with STATE.lock:
-                STATE.tasks.setdefault(commit, {"retry": 0})
-                STATE.commits.setdefault(commit, {})["queued_at"] = time.time()
-            STATE.pending.put(commit)
-            self.wfile.write(b"QUEUED\n")
-            log(f"queued commit {commit}")
-
-        elif cmd == "RESULT" and len(parts) >= 4:
-            # Runner 测试完成后回传结果：RESULT <commit> <status> <seconds>
-            commit, status, seconds = parts[1], parts[2], parts[3]
-            completed_at = time.time()
-
-            with STATE.lock:
-                # 从 assigned 中移除，释放 runner busy
-                rid = STATE.assigned.pop(commit, None)
-                if rid and rid in STATE.runners:
-                    STATE.runners[rid]["busy"] = False
-
-                # 记录完成时间
-                meta = STATE.commits.setdefault(commit, {})
-                meta["completed_at"] = completed_at
-
-            # 写结果文件（含时间线信息）
-            STATE._ensure_results_dir()
-            path = os.path.join(RESULTS_DIR, f"{commit}.txt")
-
-            with STATE.lock:
-                meta = STATE.commits.get(commit, {})
-                queued_at   = meta.get("queued_at")
-                assigned_at = meta.get("assigned_at")
-                runner_info = meta.get("runner")
-
-            # 小函数：把时间戳格式化成人类可读
-            def fmt_ts(ts_float):
-                if ts_float is None:
-                    return ""
-                return datetime.fromtimestamp(ts_float).isoformat()
-
-            # 计算各阶段耗时
-            q_to_a = (assigned_at - queued_at) if (queued_at and assigned_at) else None
-            a_to_c = (completed_at - assigned_at) if (assigned_at and completed_at) else None
-            total  = (completed_at - queued_at) if (queued_at and completed_at) else None
-
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(f"commit={commit}\n")
-                f.write(f"status={status}\n")
-                f.write(f"duration_seconds_runner={seconds}\n")  # Runner 回传的测试耗时
-                f.write(f"queued_at_local={fmt_ts(queued_at)}\n")
-                f.write(f"assigned_at_local={fmt_ts(assigned_at)}\n")
-                f.write(f"completed_at_local={fmt_ts(completed_at)}\n")
-                if runner_info:
-                    f.write(f"runner_host={runner_info[0]}\nrunner_port={runner_info[1]}\n")
-                if q_to_a is not None:
-                    f.write(f"latency_queue_to_assign_sec={q_to_a:.3f}\n")
-                if a_to_c is not None:
-                    f.write(f"latency_assign_to_finish_sec={a_to_c:.3f}\n")
-                if total is not None:
-                    f.write(f"latency_total_sec={total:.3f}\n")
-
-            self.wfile.write(b"ACK\n")
-            log(f"result {commit}: {status} ({seconds}s) -> {path}")
-
-        else:
-            # 未知指令
-            self.wfile.write(b"ERR\n")
+        # 释放 runner、记录完成时间、交给写线程落盘，全部由 state actor 异步完成；这里立刻 ACK
+        STATE.post("result", commit, status, seconds, time.time(), time.monotonic())
+        self.wfile.write(_ACK)
+        # 此时结果还没落盘，落盘后由写线程记录文件路径
+        log(f"result {commit}: {status} ({seconds}s)")
+
+    # 指令表：指令字节串 -> (处理方法, 最少参数个数)
+    _COMMANDS = {
+        b"STATUS":    (_do_status, 0),
+        b"REGISTER":  (_do_register, 2),
+        b"HEARTBEAT": (_do_heartbeat, 2),
+        b"DISPATCH":  (_do_dispatch, 1),
+        b"RESULT":    (_do_result, 3),
+    }
+
+# ====== 派发事件循环：所有 runner 的派发协程跑在同一个 asyncio 线程上 ======
+_dispatch_loop = None    # 在 main() 里创建：import 本模块时不打开事件循环占用的 fd
+_dispatch_futs = set()   # 持有派发协程的引用，防止被回收
+
+# --- 线程安全：把新 runner 的派发协程投递到事件循环 ---
+def _start_runner_dispatch(rid):
+    if _dispatch_loop is None:
+        return  # 未经 main() 启动（如被测试直接 import）：没有派发循环，任务留在队列里
+    fut = asyncio.run_coroutine_threadsafe(runner_dispatch(rid), _dispatch_loop)
+    _dispatch_futs.add(fut)
+    fut.add_done_callback(lambda f: _on_runner_dispatch_done(rid, f))
+
+# --- 派发协程结束回调：协程异常退出时记录日志并驱逐该 runner ---
+# 否则 runner 仍在册、看起来空闲，submit() 会继续往它的本地队列里放 commit，却再也没人派发
+def _on_runner_dispatch_done(rid, fut):
+    _dispatch_futs.discard(fut)
+    if fut.cancelled():
+        return
+    e = fut.exception()
+    if e is None:
+        return  # 正常退出：runner 已被驱逐
+    log(f"dispatch coroutine for {rid[0]}:{rid[1]} crashed: {e!r}")
+    STATE.evict_runner(rid)
+
+# --- 派发协程：每个 Runner 一个，消费本地队列，空闲时向邻居偷任务 ---
+async def runner_dispatch(rid):
+    me = STATE.runners.get(rid)
+    if me is None:
+        return
+    me.wakeup = asyncio.Event()
+    # runner 已被驱逐（或以新身份重新注册）：本协程退出
+    while STATE.runners.get(rid) is me:
+        # runner 正在跑上一个 commit：等它空闲再取下一个
+        if STATE.is_busy(me):
+            await asyncio.sleep(ASSIGN_TICK)
+            continue
 
-# ====== 派发线程：Round-Robin 选择空闲 Runner 并下发任务 ======
-def assigner_loop():
-    while True:
         try:
-            # 取出待分配 commit（阻塞直到拿到任务）
-            commit = STATE.pending.get(timeout=ASSIGN_TICK)
+            commit = me.local_q.get_nowait()
         except queue.Empty:
-            # 没有任务，稍作等待
-            time.sleep(ASSIGN_TICK)
+            commit = STATE.steal(rid)
+        if commit is None:
+            # 没活可干：等新任务入队的唤醒，或者 ASSIGN_TICK 后再去偷一次
+            me.wakeup.clear()
+            try:
+                await asyncio.wait_for(me.wakeup.wait(), ASSIGN_TICK)
+            except asyncio.TimeoutError:
+                pass
             continue
 
-        assigned = False
+        await dispatch_one(rid, commit)
 
-        # 不断尝试找到空闲 runner（RR 轮询）
-        rid = STATE.pick_idle_runner_rr()
-        while rid is None:
-            # 暂无空闲 runner，稍后重试
-            time.sleep(ASSIGN_TICK)
-            rid = STATE.pick_idle_runner_rr()
+# --- 把一个 commit 下发给指定 runner；失败则回收到重试队列 ---
+async def dispatch_one(rid, commit):
+    assigned = False
 
-        # 找到空闲 runner 后，先把它标记为 busy，避免并发下被其他线程同时选中
-        STATE.set_busy(rid, True)
+    # 先把 runner 标记为 busy，避免下一个 commit 被同时派给它
+    STATE.set_busy(rid, True)
 
-        rhost, rport = rid
+    rhost, rport = rid
+    try:
+        # 按你的协议：Dispatcher 主动连 Runner 的 (host,port)，发送 "RUN <commit>"
+        # 非阻塞 connect/read：一个连不上的 runner 只会拖住它自己的协程
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(rhost, rport), DISPATCH_TIMEOUT)
         try:
-            # 按你的协议：Dispatcher 主动连 Runner 的 (host,port)，发送 "RUN <commit>"
-            with socket.create_connection((rhost, rport), timeout=5) as s:
-                s.sendall(f"RUN {commit}\n".encode())
-                reply = s.recv(1024).decode().strip()
-
-            if reply == "OK":
-                # 分配成功：记录时间线与映射
-                now = time.time()
-                with STATE.lock:
-                    STATE.assigned[commit] = rid
-                    info = STATE.commits.setdefault(commit, {})
-                    info["assigned_at"] = now
-                    info["runner"] = rid
-                log(f"dispatched {commit} -> {rhost}:{rport}")
-                assigned = True
-            else:
-                # Runner 回应 BUSY/ERR：撤销 busy 状态，稍后再试
-                STATE.set_busy(rid, False)
-
+            writer.write(f"RUN {commit}\n".encode())
+            await writer.drain()
+            reply = (await asyncio.wait_for(reader.readline(), DISPATCH_TIMEOUT)).decode().strip()
+        finally:
+            writer.close()
+
+        if reply == "OK":
+            # 分配成功：记录时间线与映射
+            STATE.post("assigned", commit, rid, time.time(), time.monotonic())
+            log(f"dispatched {commit} -> {rhost}:{rport}")
+            assigned = True
+        else:
+            # Runner 回应 BUSY/ERR：撤销 busy 状态，稍后再试
+            STATE.set_busy(rid, False)
+
+    except Exception as e:
+        # 网络/连接失败或超时：认为 runner 不可用，驱逐它并回收任务到重试队列
+        log(f"runner {rhost}:{rport} unreachable: {e!r}")
+        STATE.evict_runner(rid)
+
+    if not assigned:
+        # 本轮没分配成功：把 commit 放回队列并增加重试计数
+        STATE.post("requeue", commit, "assign_failed")
+
+# ====== state actor 线程：assigned / tasks / in_flight / commits 的唯一读写者 ======
+def state_actor_loop():
+    ops = {
+        "dispatch": STATE._op_dispatch,
+        "assigned": STATE._op_assigned,
+        "result":   STATE._op_result,
+        "evict":    STATE._op_evict,
+        "requeue":  STATE._op_requeue,
+    }
+    while True:
+        op, args, reply = STATE.state_actor_q.get()
+        if op == "stop":
+            return
+        try:
+            result = ops[op](*args)
         except Exception as e:
-            # 网络/连接失败：认为 runner 不可用，驱逐它并回收任务到重试队列
-            log(f"runner {rhost}:{rport} unreachable: {e}")
-            STATE.evict_runner(rid)
-
-        if not assigned:
-            # 本轮没分配成功：把 commit 放回队列并增加重试计数（加锁在内部处理）
-            with STATE.lock:
-                STATE._requeue_commit_locked(commit, reason="assign_failed")
+            log(f"state actor op {op} failed: {e!r}")
+            result = None
+        if reply is not None:
+            reply.put(result)
 
 # ====== 清道夫线程：清理心跳超时的 Runner 并回收任务 ======
 def janitor_loop():
     while True:
-        now = time.time()
-        to_evict = []
-        with STATE.lock:
-            # 找出所有心跳超时的 runner
-            for rid, meta in list(STATE.runners.items()):
-                if now - meta["last_seen"] > RUNNER_DEAD_SECS:
-                    to_evict.append(rid)
+        now = time.monotonic()
+        # 无锁扫描 last_seen 列找出所有心跳超时的 runner（允许读到稍旧的数据，驱逐时会持锁复核）
+        to_evict = STATE.table.expired(now, RUNNER_DEAD_SECS)
         # 移除并回收任务
-        for rid in to_evict:
+        for rid, seen in to_evict:
             log(f"runner timeout: {rid[0]}:{rid[1]}")
-            STATE.evict_runner(rid)
+            STATE.evict_runner(rid, last_seen=seen)
         time.sleep(CLEANUP_TICK)
 
 # ====== 主入口 ======
 def main():
+    global _result_writer, _state_actor, _dispatch_loop
     ap = argparse.ArgumentParser()
     ap.add_argument("--host", default="127.0.0.1")     # Dispatcher 监听地址
     ap.add_argument("--port", type=int, default=8888)  # Dispatcher 监听端口
@@ -335,8 +735,18 @@ def main():
     server = ThreadedTCPServer((args.host, args.port), Handler)
     log(f"listening on {args.host}:{args.port}")
 
-    # 启动派发线程（负载均衡 + 自动重试）
-    threading.Thread(target=assigner_loop, daemon=True).start()
+    # 启动 state actor 线程（任务/时间线状态的唯一写者）
+    _state_actor = threading.Thread(target=state_actor_loop, daemon=True)
+    _state_actor.start()
+
+    # 启动结果写线程（RESULT 落盘）；进程退出前必须等它把已 ACK 的结果写完
+    _result_writer = threading.Thread(target=_result_writer_loop, daemon=True)
+    _result_writer.start()
+    atexit.register(_shutdown_result_writer)
+
+    # 启动派发事件循环线程；各 runner 的派发协程随注册按需投递（见 DispatcherState.register_runner）
+    _dispatch_loop = asyncio.new_event_loop()
+    threading.Thread(target=_dispatch_loop.run_forever, daemon=True).start()
 
     # 启动清道夫线程（心跳超时 -> 容错回收）
     threading.Thread(target=janitor_loop, daemon=True).start()
@@ -346,6 +756,8 @@ def main():
         server.serve_forever()
     except KeyboardInterrupt:
         log("shutting down...")
+    finally:
+        _shutdown_result_writer()
 
 if __name__ == "__main__":
     main()
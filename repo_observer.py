@@ -3,7 +3,8 @@
 
 """
 Repo Observer 负责：
-1) 定期 `git fetch` 远端，获取默认分支的最新 tip（origin/HEAD）
+1) 定期用 `git ls-remote` 询问远端默认分支的最新 tip（HEAD），
+   只有远端确实前进了才 `git fetch` 同步对象
 2) 发现新的 commit（与上次不同）即向 Dispatcher 发送一条：
       DISPATCH <commit>
 3) 可选：打印 STATUS 观测信息（Runner 数量、排队任务数等）
@@ -16,10 +17,10 @@ import argparse
 import os
 from utils import log
 import random
-import textwrap
 from datetime import datetime
 
-CONNECT_TIMEOUT = 3.0
+HEARTBEAT_SECS = 5.0                    # 与 dispatcher 保持一致
+CONNECT_TIMEOUT = HEARTBEAT_SECS + 2.0  # 严格大于心跳间隔（见 dispatcher 中的超时不变式）
 
 def git_rev_parse(repo_path: str, ref: str) -> str:
     """返回 git 引用的 SHA（例如 origin/HEAD）。"""
@@ -28,6 +29,58 @@ def git_rev_parse(repo_path: str, ref: str) -> str:
         stderr=subprocess.STDOUT
     ).decode().strip()
 
+def _read_packed_ref(git_dir: str, ref: str) -> str:
+    """在 packed-refs 中查找 ref，返回其 SHA；找不到返回空串。"""
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), encoding="utf-8") as f:
+            for line in f:
+                # 跳过注释(#)与 peeled 行(^)
+                if line.startswith(("#", "^")):
+                    continue
+                sha, _, name = line.rstrip("\n").partition(" ")
+                if name == ref:
+                    return sha
+    except FileNotFoundError:
+        pass
+    return ""
+
+def read_origin_head(repo_path: str) -> str:
+    """
+    直接读 .git 下的引用文件得到 origin/HEAD 的 SHA（纯文件 I/O，不起 git 子进程）。
+    支持符号引用（ref: refs/remotes/origin/main）与 packed-refs；
+    文件缺失或内容不符合预期时退回 git_rev_parse。
+    """
+    git_dir = os.path.join(repo_path, ".git")
+    ref = "refs/remotes/origin/HEAD"
+    try:
+        for _ in range(5):  # 符号引用链最多跟 5 层
+            path = os.path.join(git_dir, ref)
+            if os.path.isfile(path):
+                with open(path, encoding="utf-8") as f:
+                    content = f.read().strip()
+            else:
+                content = _read_packed_ref(git_dir, ref)
+
+            if content.startswith("ref: "):
+                ref = content[len("ref: "):].strip()
+                continue
+            if len(content) in (40, 64) and all(c in "0123456789abcdef" for c in content):
+                return content
+            break
+    except OSError:
+        pass
+    return git_rev_parse(repo_path, "origin/HEAD")
+
+def git_ls_remote_head(repo_path: str) -> str:
+    """只问远端 HEAD 指向的 SHA：一次网络往返，不下载任何对象。"""
+    out = subprocess.check_output(
+        ["git", "-C", repo_path, "ls-remote", "origin", "HEAD"],
+        stderr=subprocess.STDOUT
+    ).split()
+    if not out:
+        raise RuntimeError("remote has no HEAD (empty repository?)")
+    return out[0].decode()
+
 def git_fetch(repo_path: str):
     """拉取最新远端引用。"""
     subprocess.check_call(["git", "-C", repo_path, "fetch", "--all", "--prune"])
@@ -41,6 +94,20 @@ def send_line(dispatcher_host: str, dispatcher_port: int, line: str) -> str:
         return resp
 
 # === [AUTOGEN] helpers ===
+# 极简可测的 pytest 测例模板，pass/ fail 可控；只有 tag 随文件变化
+_TEMPLATE_OK = (
+    "def test_autogen_pass_{tag}():\n"
+    "    assert (1 + 1) == 2\n"
+)
+_TEMPLATE_FAIL = (
+    "def test_autogen_fail_{tag}():\n"
+    "    # 故意失败\n"
+    "    assert (2 + 2) == 5\n"
+)
+
+# 已确认配置过 user.name/user.email 的 repo，避免每轮都起 git config 子进程
+_git_user_configured = set()
+
 def git_config_user(repo_path: str):
     """
     确保本地 clone 有可用的 user.name/user.email（有些裸环境没有配置会导致 commit 失败）
@@ -76,29 +143,18 @@ def autogen_tests_once(repo_path: str, rel_dir: str, num_tests: int, pass_prob:
         fpath = os.path.join(repo_path, rel_dir, fname)
 
         should_pass = (random.random() < pass_prob)
-
-        # 造一个极简可测的 pytest 测例，pass/ fail 可控
-        body_ok = textwrap.dedent(f"""
-        def test_autogen_pass_{now}_{i}():
-            assert (1 + 1) == 2
-        """).strip()
-
-        body_fail = textwrap.dedent(f"""
-        def test_autogen_fail_{now}_{i}():
-            # 故意失败
-            assert (2 + 2) == 5
-        """).strip()
-
-        content = body_ok if should_pass else body_fail
+        content = (_TEMPLATE_OK if should_pass else _TEMPLATE_FAIL).format(tag=f"{now}_{i}")
 
         with open(fpath, "w", encoding="utf-8") as f:
-            f.write(content + "\n")
+            f.write(content)
 
         created_files.append(os.path.join(rel_dir, fname))
 
     # git add / commit / push
     if created_files:
-        git_config_user(repo_path)
+        if repo_path not in _git_user_configured:
+            git_config_user(repo_path)
+            _git_user_configured.add(repo_path)
         subprocess.check_call(["git", "-C", repo_path, "add", rel_dir])
         msg = f"autogen tests {now}: files={len(created_files)} pass_prob={pass_prob:.2f}"
         subprocess.check_call(["git", "-C", repo_path, "commit", "-m", msg])
@@ -134,14 +190,14 @@ def main():
     log(f"[observer] watching {repo}; dispatcher={host_d}:{port_d}; interval={args.interval}s")
 
     # === [AUTOGEN] schedule bookkeeping ===
-    last_autogen_ts = 0.0
+    last_autogen_ts = float("-inf")   # 保证第一轮立即执行
     autogen_gap = args.autogen_every if args.autogen_every > 0 else args.interval
 
     while True:
         try:
             # === [AUTOGEN] periodic test generation & push ===
             if args.autogen_tests > 0:
-                now_ts = time.time()
+                now_ts = time.monotonic()
                 if now_ts - last_autogen_ts >= autogen_gap:
                     try:
                         autogen_tests_once(
@@ -158,21 +214,22 @@ def main():
                     finally:
                         last_autogen_ts = now_ts
 
-            # 1) 同步远端
-            git_fetch(repo)
-
-            # 2) 读取远端默认分支 tip（注意：这是远端的 HEAD 指向，如 origin/main）
-            tip = git_rev_parse(repo, "origin/HEAD")
+            # 1) 读取远端默认分支 tip（注意：这是远端的 HEAD 指向，如 origin/main）
+            #    ls-remote 只拿一个 SHA，远端没变化时省掉整次 fetch
+            tip = git_ls_remote_head(repo)
 
-            # 3) 如果 tip 与上次不同，触发一个新的 DISPATCH
+            # 2) 如果 tip 与上次不同，触发一个新的 DISPATCH
             if tip != last:
+                # 本地 origin/HEAD 落后于远端时才真正 fetch（autogen 推送后本地引用通常已是最新）
+                if tip != read_origin_head(repo):
+                    git_fetch(repo)
                 resp = send_line(host_d, port_d, f"DISPATCH {tip}")
                 log(f"[observer] new tip={tip[:12]} queued -> {resp}")
                 last = tip
             else:
                 log("[observer] no changes")
 
-            # 4) 可选：探测当前系统状态（便于调试/监控）
+            # 3) 可选：探测当前系统状态（便于调试/监控）
             try:
                 status = send_line(host_d, port_d, "STATUS")
                 log(f"[observer] STATUS -> {status}")
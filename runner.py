@@ -5,11 +5,13 @@
 Runner 负责：
 1) 监听来自 Dispatcher 的 RUN <commit> 指令（本地 TCP 端口）
 2) 收到 RUN 后立刻回复 OK，然后后台执行测试（避免阻塞 Dispatcher）
-3) 测试完成后，主动连接 Dispatcher 上报 RESULT <commit> <status> <seconds>
+3) 测试完成后，向 Dispatcher 上报 RESULT <commit> <status> <seconds>
 4) 定期向 Dispatcher 发送 HEARTBEAT <runner_host> <runner_port>（容错所需）
 5) 启动时向 Dispatcher 发送 REGISTER <runner_host> <runner_port>
+以上 3)~5) 复用同一条到 Dispatcher 的长连接
 """
 
+import select
 import socket
 import socketserver
 import threading
@@ -17,13 +19,21 @@ import time
 import argparse
 import subprocess
 import os
+import sys
+import multiprocessing
 import random                      # ✅ 用于“随机失败”
 from utils import log              # 统一日志
 
+try:
+    import pytest                  # ✅ 可选：能导入就直接调用 pytest.main，省掉每次起解释器
+except ImportError:
+    pytest = None
+
 # ===== 与 dispatcher 保持一致的参数（可按需微调）=====
 HEARTBEAT_SECS = 5.0              # 每隔 5s 上报一次心跳
-CONNECT_TIMEOUT = 3.0             # 各类短连的超时
+CONNECT_TIMEOUT = HEARTBEAT_SECS + 2.0  # 连接/收发超时：严格大于心跳间隔，避免单个包延迟就误判掉线
 RANDOM_FAIL_PROB = 0.30           # ✅ 全部测试通过时，额外 30% 概率故意返回 FAIL
+PYTEST_ARGS = ["-q", "--maxfail=1"]  # -q 安静模式；--maxfail=1 失败就尽早退出
 
 # ========== 运行时全局状态 ==========
 class RunnerState:
@@ -41,12 +51,77 @@ class RunnerState:
 
 STATE = RunnerState()
 
+# ============ 到 Dispatcher 的长连接 ============
+class _DispatcherConn:
+    """
+    REGISTER/HEARTBEAT/RESULT 复用同一条 TCP 连接（一行一帧，一问一答），
+    避免每次心跳都重新握手、让 Dispatcher 多 accept 一次并多起一个线程。
+    指令发出之前连接失效则自动重连并重发一次；已经发出后才失败（读超时/对端断开）
+    不重发，避免 Dispatcher 重复处理同一条 RESULT。
+    """
+    def __init__(self):
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()          # 同一时刻只允许一个请求在连接上往返
+
+    def _connect(self):
+        host, port = STATE.dispatcher
+        self.sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        self.rfile = self.sock.makefile("rb")
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.rfile.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.rfile = None
+
+    def _stale(self) -> bool:
+        # 一问一答：空闲时连接上不该有任何可读数据，可读只能是对端已关闭（EOF/RST）
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def _send(self, data: bytes):
+        if self.sock is not None and self._stale():
+            self._close()   # 旧连接已被对端关闭（如 Dispatcher 空闲超时）：发送前先换新连接
+        if self.sock is None:
+            self._connect()
+        self.sock.sendall(data)
+
+    def request(self, line: str) -> str:
+        """发送一行指令并返回一行回复。"""
+        data = (line.strip() + "\n").encode("utf-8")
+        with self.lock:
+            try:
+                self._send(data)
+            except OSError:
+                # 指令还没完整发出：Dispatcher 不可能处理过它，重连后重发一次是安全的
+                self._close()
+                try:
+                    self._send(data)
+                except OSError:
+                    self._close()
+                    raise
+            # 已经发出：之后任何失败都只关闭连接并上报，不重发
+            try:
+                reply = self.rfile.readline()
+            except OSError:
+                self._close()
+                raise
+            if not reply:
+                self._close()
+                raise ConnectionError("dispatcher closed connection")
+            return reply.decode("utf-8").strip()
+
+_DISPATCHER = _DispatcherConn()
+
 # ================== 工具函数 ==================
-def _send_line_to_dispatcher(line: str):
-    """给 Dispatcher 发一条文本指令（短连接，一次性发送）。"""
-    host, port = STATE.dispatcher
-    with socket.create_connection((host, port), timeout=CONNECT_TIMEOUT) as s:
-        s.sendall((line.strip() + "\n").encode("utf-8"))
+def _send_line_to_dispatcher(line: str) -> str:
+    """给 Dispatcher 发一条文本指令（走长连接），返回 Dispatcher 的一行回复。"""
+    return _DISPATCHER.request(line)
 
 def _safe_send_dispatcher(line: str):
     """带异常吞吐的版本，避免硬崩；失败时仅打印日志。"""
@@ -59,6 +134,25 @@ def _ensure_dir(path: str):
     """确保目录存在。"""
     os.makedirs(path, exist_ok=True)
 
+def _pytest_child(args):
+    """子进程入口：退出码即 pytest.main 的返回值。"""
+    sys.exit(int(pytest.main(args)))
+
+def _run_pytest() -> int:
+    """
+    执行一轮 pytest，返回退出码。
+    优先在 forkserver 子进程里调用 pytest.main：forkserver 启动时已预先 import pytest，
+    每次只需 fork，不必重新启动解释器、发现插件；同时每轮测试仍在独立进程中，
+    测试导入的模块/插件副作用不会污染 Runner 本身（Runner 是多线程进程，直接 fork 它并不安全）。
+    pytest 不可用或平台不支持 forkserver 时，退回到 subprocess 调用 pytest 命令。
+    """
+    if pytest is None or "forkserver" not in multiprocessing.get_all_start_methods():
+        return subprocess.call(["pytest", *PYTEST_ARGS])
+    p = multiprocessing.get_context("forkserver").Process(target=_pytest_child, args=(PYTEST_ARGS,))
+    p.start()
+    p.join()
+    return p.exitcode
+
 # ============ 业务：执行某个 commit 的测试 ============
 def run_tests_for_commit(commit: str) -> tuple[str, float]:
     """
@@ -70,14 +164,14 @@ def run_tests_for_commit(commit: str) -> tuple[str, float]:
       status: "OK" 或 "FAIL"
       seconds: 执行耗时
     """
-    start = time.time()
+    start = time.monotonic()
 
     # 1) 可选：准备工作目录（此示例未做 git 检出，直接在项目根目录跑 pytest）
     _ensure_dir(STATE.workdir)
 
-    # 2) 真正执行 pytest（-q 安静模式；--maxfail=1 失败就尽早退出）
+    # 2) 真正执行 pytest（参数见 PYTEST_ARGS）
     #    cwd=当前进程启动目录（你的仓库根目录，含 tests/）。
-    rc = subprocess.call(["pytest", "-q", "--maxfail=1"])
+    rc = _run_pytest()
     base_status = "OK" if rc == 0 else "FAIL"
 
     # 3) 如果基础结果 OK，则叠加“随机失败”概率（默认 30%）
@@ -92,7 +186,7 @@ def run_tests_for_commit(commit: str) -> tuple[str, float]:
     else:
         status = "FAIL"
 
-    seconds = time.time() - start
+    seconds = time.monotonic() - start
     return status, seconds
 
 # ============ 任务执行线程 ============
@@ -184,6 +278,10 @@ def main():
     STATE.dispatcher = (dh, int(dp))
     STATE.me = (args.host, args.port)
 
+    # forkserver 预先导入 pytest，之后每轮测试只需 fork
+    if pytest is not None and "forkserver" in multiprocessing.get_all_start_methods():
+        multiprocessing.get_context("forkserver").set_forkserver_preload(["pytest"])
+
     # 先注册
     register_once()
 
@@ -1,16 +1,80 @@
-from datetime import datetime
+import atexit
 import os
+import queue
+import sys
+import threading
+import time
+
+LOG_DIR = "test_results"
+LOG_PATH = os.path.join(LOG_DIR, "ci_log.txt")
+LOG_QUEUE_MAX = 10000     # 队列满时直接丢弃新日志，绝不阻塞调用方
+LOG_BATCH_MAX = 256       # 写线程单次最多合并的行数
+
+_q = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_writer = None
+_writer_lock = threading.Lock()
+_STOP = object()
+
+def _write_all(fd: int, data: bytes):
+    """os.write 可能只写入一部分，循环直到写完"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _writer_loop():
+    """后台写线程：独占日志文件描述符，批量写终端与文件"""
+    os.makedirs(LOG_DIR, exist_ok=True)  # 只在启动时确保目录存在
+    # 直接用 O_APPEND 的裸 fd：绕过 Python 文本/缓冲层，每批日志一次 write 系统调用，
+    # 追加写由内核保证原子性，多个进程共用同一个日志文件也不会互相覆盖
+    fd = os.open(LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        while True:
+            lines = [_q.get()]
+            while len(lines) < LOG_BATCH_MAX:
+                try:
+                    lines.append(_q.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = _STOP in lines
+            if stop:
+                lines = [l for l in lines if l is not _STOP]
+            if lines:
+                buf = "\n".join(lines) + "\n"
+                # 1️⃣ 打印到终端
+                sys.stdout.write(buf)
+                sys.stdout.flush()
+                # 2️⃣ 写入日志文件
+                _write_all(fd, buf.encode("utf-8"))
+            if stop:
+                return
+    finally:
+        os.close(fd)
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name="log-writer", daemon=True)
+            _writer.start()
+            atexit.register(_shutdown)
+
+def _shutdown():
+    """进程退出前把队列里剩余的日志写完"""
+    try:
+        _q.put(_STOP, timeout=1.0)
+    except queue.Full:
+        return
+    _writer.join(timeout=2.0)
 
 def log(msg: str):
-    """统一日志输出：打印到终端并写入文件"""
-    ts = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-    line = f"[{ts}] {msg}"
-
-    # 1️⃣ 打印到终端
-    print(line)
-
-    # 2️⃣ 写入日志文件
-    os.makedirs("test_results", exist_ok=True)  # 确保目录存在
-    log_path = os.path.join("test_results", "ci_log.txt")
-    with open(log_path, "a", encoding="utf-8") as f:
-        print(line, file=f)
+    """统一日志输出：格式化后交给后台线程，打印到终端并写入文件"""
+    if _writer is None:
+        _start_writer()
+
+    t = time.time()
+    ts = time.strftime("%H:%M:%S", time.localtime(t)) + f".{int(t % 1 * 1000):03d}"
+    try:
+        _q.put_nowait(f"[{ts}] {msg}")
+    except queue.Full:
+        pass  # 日志过载：丢弃这一行